@@ -4,8 +4,12 @@ Simple script to change the content moderation threshold.
 Usage: python change_threshold.py 0.25
 """
 
+import os
 import sys
 import re
+import shutil
+
+THRESHOLD_PATTERN = re.compile(r'self\.similarity_threshold = \d+\.\d+')
 
 def change_threshold(new_threshold):
     """Change the threshold in content_moderator.py"""
@@ -29,22 +33,32 @@ def change_threshold(new_threshold):
         print(f"Error: {file_path} not found")
         return False
     
-    # Replace the threshold
-    old_pattern = r'self\.similarity_threshold = \d+\.\d+'
+    # Replace the threshold in a single pass
     new_line = f'self.similarity_threshold = {threshold_value}'
+    new_content, replacements = THRESHOLD_PATTERN.subn(new_line, content)
     
-    if re.search(old_pattern, content):
-        new_content = re.sub(old_pattern, new_line, content)
-        
-        # Write back to file
-        with open(file_path, 'w') as f:
-            f.write(new_content)
-        
-        print(f"✅ Threshold changed to {threshold_value}")
-        return True
-    else:
+    if not replacements:
         print("Error: Could not find threshold line in content_moderator.py")
         return False
+    
+    # Write to a temp file and swap it in so the module is never half-written
+    tmp_path = file_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(new_content)
+        # keep the original file's permissions rather than the umask default
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except OSError as e:
+        print(f"Error: Could not write {file_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    
+    print(f"✅ Threshold changed to {threshold_value}")
+    return True
 
 def main():
     """Main function"""
@@ -1,15 +1,34 @@
 import os
+import orjson
+import functools
+import logging
+import queue
+import tempfile
+import hashlib
+import threading
+import zipfile
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
 import requests
-from moviepy.editor import VideoFileClip
-from typing import List
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import av
+from typing import List, Optional, Tuple, Union, BinaryIO
 import numpy as np
 from PIL import Image
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import torch
+import torch.nn.functional as F
 from transformers.models.clip.processing_clip import CLIPProcessor
 from transformers.models.clip.modeling_clip import CLIPModel
+from transformers.image_utils import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
 from content_moderator import ContentModerator
+from http_range_file import HTTPRangeFile, content_range_total
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()  # Loads variables from .env into environment
 
@@ -19,40 +38,263 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("SUPABASE_URL and/or SUPABASE_KEY are not set. Check your .env file and environment variables.")
 
-# Load CLIP model globally
-print("Loading CLIP model...")
-clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-print("✓ CLIP model loaded successfully")
+# Number of media_clips rows fetched from Supabase per request
+MEDIA_CLIPS_PAGE_SIZE = 200
+
+# Number of clips downloaded and decoded concurrently while earlier clips are embedded
+DOWNLOAD_WORKERS = 8
+
+# Read size used when copying a download into memory
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# (connect, read) timeout in seconds for video downloads
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Shared session so downloads reuse keep-alive connections to the storage host
+# instead of paying a new TCP + TLS handshake per clip; throttling (429) and
+# transient server errors are retried with backoff, honouring Retry-After
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=DOWNLOAD_WORKERS,
+    pool_maxsize=DOWNLOAD_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# Videos larger than this are not downloaded in full: they are read with HTTP
+# Range requests, so only the container index and the data around each sampled
+# frame are transferred. Set to 0 to always download the whole video.
+RANGE_READ_MIN_SIZE = 32 * 1024 * 1024
+
+# Bytes fetched per Range request
+RANGE_BLOCK_SIZE = 1024 * 1024
+
+# Largest video downloaded in full. Only applies when the server doesn't
+# support Range requests; larger videos fail instead of filling memory or disk.
+MAX_DOWNLOAD_SIZE = 512 * 1024 * 1024
+
+# Full downloads stay in memory up to this size and spill over to a temporary
+# file beyond it, so concurrent downloads can't exhaust memory
+DOWNLOAD_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Positions, as fractions of the video's duration, of the frames sampled from each clip
+FRAME_PERCENTAGES = [0.25, 0.5, 0.75]
+
+# Set FRAME_CACHE_DIR to keep each clip's sampled frames on disk, so later runs
+# skip downloading and decoding clips whose URL they have already seen.
+# Clear the directory if videos are replaced in place at the same URL.
+FRAME_CACHE_DIR = os.getenv("FRAME_CACHE_DIR", "")
+
+# Cache hits and misses of this run, updated from the download threads
+frame_cache_stats = Counter()
+frame_cache_lock = threading.Lock()
+
+# Frames from consecutive clips are embedded together in batches of up to this
+# many frames. Raise it on GPUs with spare memory, lower it if a batch runs out.
+INFERENCE_BATCH_SIZE = int(os.getenv("MODEL_INFERENCE_BATCH_SIZE", "32"))
+
+# Frames of a clip whose 64-bit perceptual hashes differ in at most this many
+# bits are treated as the same shot and embedded once. Set to -1 to disable.
+FRAME_DEDUP_DISTANCE = int(os.getenv("FRAME_DEDUP_DISTANCE", "4"))
+
+# Set SAVE_FRAMES=1 to also write every extracted frame to disk as a JPEG.
+# Off by default: nothing in the pipeline reads the frames back.
+SAVE_FRAMES = os.getenv("SAVE_FRAMES", "0") == "1"
+
+# File format of saved frames: "jpg" for viewing, or "npy" to dump the raw
+# RGB array without spending CPU on encoding (load with np.load)
+FRAME_SAVE_FORMAT = os.getenv("FRAME_SAVE_FORMAT", "jpg")
+if FRAME_SAVE_FORMAT not in ("jpg", "npy"):
+    raise ValueError(f"FRAME_SAVE_FORMAT must be 'jpg' or 'npy', got '{FRAME_SAVE_FORMAT}'")
+
+# Background threads that encode and write frames off the main pipeline
+frame_writer = ThreadPoolExecutor(max_workers=4)
+
+# Set COMPILE_MODEL=1 to compile the CLIP vision encoder with torch.compile.
+# Compilation adds a one-off cost on the first batch, so it only pays off on long runs.
+COMPILE_MODEL = os.getenv("COMPILE_MODEL", "0") == "1"
+
+# Run CLIP on the GPU in float16 when one is available
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Set QUANTIZE_MODEL=1 to run the vision encoder's linear layers in int8 (CPU only)
+QUANTIZE_MODEL = os.getenv("QUANTIZE_MODEL", "0") == "1" and DEVICE == "cpu"
+
+# Set USE_BF16=1 to run the vision encoder in bfloat16. Worth it on CPUs with
+# native BF16 support (AVX512-BF16 / AMX, ARM SVE-BF16); ignored with QUANTIZE_MODEL.
+USE_BF16 = os.getenv("USE_BF16", "0") == "1" and DEVICE == "cpu" and not QUANTIZE_MODEL
+
+# Set CHANNELS_LAST=1 to keep the vision encoder's conv weights and input
+# batches in NHWC layout (GPU only). Only the patch embedding of CLIP's ViT
+# is a convolution, so measure before enabling it.
+CHANNELS_LAST = os.getenv("CHANNELS_LAST", "0") == "1" and DEVICE == "cuda"
 
-# Initialize content moderator
-print("Initializing content moderator...")
-content_moderator = ContentModerator(clip_model, clip_processor)
-print("✓ Content moderator initialized successfully")
+if DEVICE == "cuda":
+    IMAGE_DTYPE = torch.float16
+elif USE_BF16:
+    IMAGE_DTYPE = torch.bfloat16
+else:
+    IMAGE_DTYPE = torch.float32
 
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+
+# CLIP image preprocessing constants (input resolution and OpenAI normalization)
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = torch.tensor(OPENAI_CLIP_MEAN).view(1, 3, 1, 1)
+CLIP_STD = torch.tensor(OPENAI_CLIP_STD).view(1, 3, 1, 1)
+
+@functools.lru_cache(maxsize=1)
+def get_clip():
+    """
+    Load the CLIP model and processor the first time they are needed.
+    Importing this module (e.g. just to call fetch_media_clips) doesn't pay
+    for loading the model.
+    
+    Returns:
+        (clip_model, clip_processor) tuple
+    """
+    logger.info("Loading CLIP model...")
+    clip_model = CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+    clip_processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+    clip_model.to(DEVICE)
+    clip_model.eval()
+    logger.info("✓ CLIP model loaded successfully on %s", DEVICE)
+
+    if DEVICE == "cuda":
+        # fp16 weights run on the tensor cores and halve memory traffic
+        clip_model.half()
+        if CHANNELS_LAST:
+            clip_model.vision_model.to(memory_format=torch.channels_last)
+    elif QUANTIZE_MODEL:
+        logger.info("Quantizing CLIP vision encoder to int8...")
+        # dynamic quantization: weights are stored as int8 and activations are
+        # quantized on the fly, so the matmuls run on the int8 (VNNI) kernels
+        clip_model.vision_model = torch.quantization.quantize_dynamic(
+            clip_model.vision_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif USE_BF16:
+        logger.info("Casting CLIP vision encoder to bfloat16...")
+        # halves the weight bytes streamed per forward; the text tower stays fp32
+        clip_model.vision_model.to(IMAGE_DTYPE)
+        clip_model.visual_projection.to(IMAGE_DTYPE)
+
+    if COMPILE_MODEL:
+        logger.info("Compiling CLIP vision encoder...")
+        torch.set_float32_matmul_precision('high')
+        torch.backends.cudnn.benchmark = True
+        # compile the vision tower itself: get_image_features calls it directly,
+        # so wrapping the whole CLIPModel would leave the image path uncompiled
+        eager_vision_model = clip_model.vision_model
+        clip_model.vision_model = torch.compile(eager_vision_model, mode="reduce-overhead", dynamic=False)
+        try:
+            # compilation is lazy, so run a batch now so any failure shows up
+            # here; get_image_embeddings pads every batch to this same size,
+            # so this one graph is reused instead of recompiling per batch size
+            dummy = torch.zeros(INFERENCE_BATCH_SIZE, 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE, device=DEVICE, dtype=IMAGE_DTYPE)
+            if CHANNELS_LAST:
+                dummy = dummy.contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                clip_model.vision_model(pixel_values=dummy)
+            logger.info("✓ CLIP vision encoder compiled")
+        except Exception as e:
+            logger.warning("✗ Compilation failed, using the eager model: %s", e)
+            clip_model.vision_model = eager_vision_model
+
+    return clip_model, clip_processor
+
+@functools.lru_cache(maxsize=1)
+def get_content_moderator() -> ContentModerator:
+    """
+    Create the content moderator on first use, sharing the cached CLIP model.
+    """
+    logger.info("Initializing content moderator...")
+    content_moderator = ContentModerator(*get_clip())
+    logger.info("✓ Content moderator initialized successfully")
+    return content_moderator
+
+@functools.lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
+    # Built once per process so every caller shares the same HTTP session
     # Type assertion to tell the linter these are strings (we already checked they're not None)
     return create_client(SUPABASE_URL, SUPABASE_KEY)  # type: ignore
 
-def fetch_media_clips():
+def iter_media_clips(page_size: int = MEDIA_CLIPS_PAGE_SIZE):
+    """
+    Yield media clips one page at a time, so processing can start as soon
+    as the first page arrives instead of after the whole table is fetched.
+    """
     supabase = get_supabase_client()
-    response = supabase.table('media_clips').select('*').execute()
-    return response.data
+    offset = 0
+    while True:
+        # only the columns the pipeline uses, so wide columns never go over the wire;
+        # ordered by id so pages don't overlap or skip rows
+        response = (
+            supabase.table('media_clips')
+            .select('id,title,clip_path')
+            .order('id')
+            .range(offset, offset + page_size - 1)
+            .execute()
+        )
+        yield from response.data
+        if len(response.data) < page_size:
+            return
+        offset += page_size
 
-def get_image_embedding(image: Image.Image) -> np.ndarray:
+def fetch_media_clips():
+    return list(iter_media_clips())
+
+def preprocess_frames(frames: List[np.ndarray]) -> torch.Tensor:
     """
-    Get CLIP embedding for a single image.
-    Returns a numpy array of the embedding vector.
+    Resize, center-crop and normalize RGB frames for CLIP on DEVICE.
+    Each uint8 (H, W, 3) frame is copied to the device once and resized there,
+    so frames never go through PIL and the full-resolution float copy only
+    exists on the device.
+    Returns a tensor of shape (len(frames), 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE).
+    """
+    size = CLIP_IMAGE_SIZE
+    pixel_values = torch.empty((len(frames), 3, size, size), device=DEVICE)
+    for i, frame in enumerate(frames):
+        image = torch.from_numpy(frame).to(DEVICE).permute(2, 0, 1).unsqueeze(0).float()
+        # resize the shortest side to the crop size, then take the center square
+        height, width = image.shape[-2:]
+        short_side = min(width, height)
+        height, width = max(size, int(size * height / short_side)), max(size, int(size * width / short_side))
+        image = F.interpolate(image, size=(height, width), mode="bicubic", antialias=True, align_corners=False)
+        top, left = (height - size) // 2, (width - size) // 2
+        pixel_values[i] = image[0, :, top:top + size, left:left + size]
+    
+    pixel_values.clamp_(0, 255).div_(255)
+    return pixel_values.sub_(CLIP_MEAN.to(DEVICE)).div_(CLIP_STD.to(DEVICE))
+
+def get_image_embeddings(frames: List[np.ndarray]) -> np.ndarray:
+    """
+    Get CLIP embeddings for a batch of RGB frames in a single forward pass.
+    Returns a numpy array of shape (len(frames), embedding_dim).
     """
-    # Process the image through CLIP processor
-    inputs = clip_processor(images=image, return_tensors="pt", padding=True)  # type: ignore
+    pixel_values = preprocess_frames(frames).to(IMAGE_DTYPE)
+    num_frames = len(pixel_values)
+    if COMPILE_MODEL and num_frames < INFERENCE_BATCH_SIZE:
+        # the compiled graph is specialized for INFERENCE_BATCH_SIZE frames;
+        # pad with blank frames rather than trigger a compile per batch size
+        padding = pixel_values.new_zeros((INFERENCE_BATCH_SIZE - num_frames, *pixel_values.shape[1:]))
+        pixel_values = torch.cat([pixel_values, padding])
+    if CHANNELS_LAST:
+        pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
     
     # Get image features from CLIP model
-    with torch.no_grad():
-        image_features = clip_model.get_image_features(**inputs)  # type: ignore
+    clip_model, _ = get_clip()
+    with torch.inference_mode():
+        image_features = clip_model.get_image_features(pixel_values=pixel_values)  # type: ignore
     
-    # Convert to numpy array and flatten
-    return image_features.numpy().flatten()
+    return image_features[:num_frames].float().cpu().numpy()
+
+def get_image_embedding(image: Image.Image) -> np.ndarray:
+    """
+    Get CLIP embedding for a single image.
+    Returns a numpy array of the embedding vector.
+    """
+    return get_image_embeddings([np.array(image.convert("RGB"))])[0]
 
 def check_content_moderation(image_embedding: np.ndarray, clip_title: str) -> dict:
     """
@@ -65,151 +307,493 @@ def check_content_moderation(image_embedding: np.ndarray, clip_title: str) -> di
     Returns:
         Dictionary with moderation results
     """
-    print(f"Checking content moderation for: {clip_title}")
-    moderation_results = content_moderator.check_image_content(image_embedding)
+    logger.info("Checking content moderation for: %s", clip_title)
+    moderation_results = get_content_moderator().check_image_content(image_embedding)
+    log_moderation_results(moderation_results, clip_title)
+    return moderation_results
+
+def log_moderation_results(moderation_results: dict, clip_title: str):
+    """
+    Log the outcome of a moderation check, with the flagged categories.
     
+    Args:
+        moderation_results: Moderation results dictionary of one image
+        clip_title: Title of the clip for logging
+    """
     if moderation_results["flagged"]:
-        print(f"⚠️  CONTENT FLAGGED for {clip_title}")
-        print(f"   Max similarity: {moderation_results['max_similarity']:.3f}")
-        print(f"   Most similar content: '{moderation_results['most_similar_content']}'")
+        logger.warning("⚠️  CONTENT FLAGGED for %s", clip_title)
+        logger.warning("   Max similarity: %.3f", moderation_results['max_similarity'])
+        logger.warning("   Most similar content: '%s'", moderation_results['most_similar_content'])
         
-        # Print category breakdown
+        # Log category breakdown
         for category, details in moderation_results["categories"].items():
             if details["flagged"]:
-                print(f"   Category '{category}': {details['max_similarity']:.3f} (word: '{details['most_similar_word']}')")
+                logger.warning("   Category '%s': %.3f (word: '%s')", category, details['max_similarity'], details['most_similar_word'])
     else:
-        print(f"✓ Content OK for {clip_title} (max similarity: {moderation_results['max_similarity']:.3f})")
-    
-    return moderation_results
+        logger.info("✓ Content OK for %s (max similarity: %.3f)", clip_title, moderation_results['max_similarity'])
 
-def extract_frames_at_percentages(video_path: str, percentages: List[float] = [0.25, 0.5, 0.75]) -> List[Image.Image]:
+def extract_frames_at_percentages(video_path: Union[str, BinaryIO], percentages: List[float] = [0.25, 0.5, 0.75]) -> List[Image.Image]:
     """
     Extract frames from the video at the given percentages of its duration.
     Returns a list of PIL Images.
     """
+    return [Image.fromarray(frame) for frame in extract_frame_arrays(video_path, percentages)]
+
+def extract_frame_arrays(video_path: Union[str, BinaryIO], percentages: List[float] = [0.25, 0.5, 0.75],
+                         short_side: Optional[int] = None) -> List[np.ndarray]:
+    """
+    Extract frames from the video at the given percentages of its duration.
+    The video can be a local path or a seekable file-like object.
+    If short_side is given, larger frames are scaled down (keeping their aspect
+    ratio) so their shorter side is short_side, in the same pass as the
+    conversion to RGB.
+    Returns a list of uint8 RGB arrays of shape (height, width, 3).
+    """
 
     # checks if the video path exists in the local file system 
     # if it doesnt then raise an error 
-    if not os.path.exists(video_path):
+    if isinstance(video_path, str) and not os.path.exists(video_path):
         raise FileNotFoundError(f"Video file not found: {video_path}")
 
-    # create a video clip object from the path 
-    clip = VideoFileClip(video_path)
-    duration = clip.duration
     frames = []
-    for pct in percentages:
-        t = duration * pct
-        frame = clip.get_frame(t)
-        # Convert numpy array to PIL Image
-        if frame is None: 
-            print(f"No frame found at {t} seconds for {video_path}")
-            continue
-        else: 
-            print(f"Extracted frame at {t:.2f} seconds, shape: {getattr(frame, 'shape', None)}")
-        img = Image.fromarray(np.uint8(frame))
-        frames.append(img)
-    clip.close()
+    # mode must be explicit: for file objects PyAV otherwise takes it from
+    # their .mode, and a SpooledTemporaryFile reports 'w+b'
+    with av.open(video_path, mode="r") as container:
+        stream = container.streams.video[0]
+        # let the decoder use frame and slice threads
+        stream.thread_type = "AUTO"
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        else:
+            duration = container.duration / av.time_base
+        start_pts = stream.start_time or 0
+        
+        for pct in percentages:
+            t = duration * pct
+            target_pts = start_pts + int(t / stream.time_base)
+            # jump to the keyframe at or before the target, then decode forward
+            # to the frame that is on screen at that time
+            container.seek(target_pts, stream=stream, any_frame=False, backward=True)
+            frame = None
+            for frame in container.decode(stream):
+                if frame.pts is not None and frame.pts >= target_pts:
+                    break
+            if frame is None: 
+                logger.info("No frame found at %s seconds", t)
+                continue
+            
+            width, height = frame.width, frame.height
+            if short_side and min(width, height) > short_side:
+                if width < height:
+                    width, height = short_side, round(height * short_side / width)
+                else:
+                    width, height = round(width * short_side / height), short_side
+            logger.info("Extracted frame at %.2f seconds, shape: %s", t, (height, width, 3))
+            frames.append(frame.to_ndarray(width=width, height=height, format="rgb24", interpolation="AREA"))
     return frames
 
 
-# downloads a video from a url and saves it as a local file 
-def download_video(url, local_path):
-    print(f"  Downloading from: {url}")
-    print(f"  Saving to: {local_path}")
-    try:
-        response = requests.get(url, stream=True)
+def fetch_into(video: BinaryIO, url: str, headers=None):
+    """
+    Stream a GET response body onto the end of a file.
+    Raises IOError if the file would grow past MAX_DOWNLOAD_SIZE.
+    Returns the response (already closed).
+    """
+    with http_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
         response.raise_for_status()
-        with open(local_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"  Download completed!")
+        content_length = response.headers.get("Content-Length", "")
+        if content_length.isdigit() and video.tell() + int(content_length) > MAX_DOWNLOAD_SIZE:
+            raise IOError(f"Video is larger than {MAX_DOWNLOAD_SIZE} bytes: {url}")
+        # let urllib3 undo any Content-Encoding, then copy the body in large
+        # blocks, checking the size as we go in case Content-Length was missing
+        response.raw.decode_content = True
+        while True:
+            chunk = response.raw.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            video.write(chunk)
+            if video.tell() > MAX_DOWNLOAD_SIZE:
+                raise IOError(f"Video is larger than {MAX_DOWNLOAD_SIZE} bytes: {url}")
+    return response
+
+
+# downloads a video from a url, or opens it for range reads if it's large
+def download_video(url) -> BinaryIO:
+    logger.info("  Downloading from: %s", url)
+    video = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE)
+    try:
+        if not RANGE_READ_MIN_SIZE:
+            fetch_into(video, url)
+        else:
+            # ask for the first block only: a 206 reply tells us the server
+            # supports Range requests and how large the video is
+            response = fetch_into(video, url, headers={"Range": f"bytes=0-{RANGE_BLOCK_SIZE - 1}"})
+            if response.status_code == 206:
+                total_size = content_range_total(response)
+                if total_size is not None and total_size > RANGE_READ_MIN_SIZE:
+                    range_file = HTTPRangeFile(http_session, url, total_size, block_size=RANGE_BLOCK_SIZE, timeout=DOWNLOAD_TIMEOUT)
+                    # a server may answer with a shorter range than asked for;
+                    # then let the range file fetch the first block itself
+                    if video.tell() == range_file.block_length(0):
+                        video.seek(0)
+                        range_file.add_block(0, video.read())
+                    video.close()
+                    logger.info("  Reading %s with range requests (%d bytes total)", url, total_size)
+                    return range_file
+                if total_size is None:
+                    downloaded = video.tell()
+                    response = fetch_into(video, url, headers={"Range": f"bytes={downloaded}-"})
+                    # a 200 would be the whole video again, appended after the first block
+                    if response.status_code != 206:
+                        raise IOError(f"Server ignored Range request for {url} at byte {downloaded}")
+                # fetch the rest; servers may cap the length of each range
+                while total_size is not None and video.tell() < total_size:
+                    downloaded = video.tell()
+                    response = fetch_into(video, url, headers={"Range": f"bytes={downloaded}-"})
+                    if response.status_code != 206 or video.tell() == downloaded:
+                        raise IOError(f"Incomplete range reply for {url} at byte {downloaded}")
+        logger.info("  Download completed: %s (%d bytes)", url, video.tell())
+        video.seek(0)
+        return video
     except Exception as e:
-        print(f"  ✗ Download error: {e}")
+        video.close()
+        logger.error("  ✗ Download error for %s: %s", url, e)
         raise
 
 
-def process_all_clips():
-    # store all the clips in the database 
-    clips = fetch_media_clips()
-    print(f"Found {len(clips)} clips in database")
-    
-    for clip in clips:
-        # storing the video urls we find in the database here 
-        video_url = clip['clip_path']
-        print(f"\n=== CLIP INFO ===")
-        print(f"Title: {clip['title']}")
-        print(f"Clip path from DB: '{video_url}'")
-        # Get the file extension from the URL
-        file_extension = video_url.split('.')[-1].split('?')[0]  # Remove query parameters
-        # creating a temp local path to store the video with correct extension
-        local_path = f"/tmp/{clip['id']}.{file_extension}"
+def load_clip_frames(clip) -> List[np.ndarray]:
+    """
+    Download a clip's video and extract its frames.
+    Runs on the download pool, so decoding (and any range reads it triggers)
+    overlaps with other downloads and with CLIP inference on the main thread.
+    """
+    cache_path = frame_cache_path(clip['clip_path']) if FRAME_CACHE_DIR else None
+    if cache_path:
+        frames = load_frame_cache(cache_path)
+        if frames is not None:
+            record_frame_cache("hits")
+            logger.info("  Loaded cached frames for %s", clip['clip_path'])
+            return frames
+    
+    with download_video(clip['clip_path']) as video:
+        frames = extract_frame_arrays(video, FRAME_PERCENTAGES, short_side=decode_short_side())
+    
+    if cache_path:
+        record_frame_cache("misses")
+        if frames:
+            save_frame_cache(cache_path, frames)
+    return frames
+
+
+def decode_short_side() -> Optional[int]:
+    """
+    Size of the shorter side frames are decoded at. Unless frames are saved
+    at full resolution, they are scaled to CLIP's input size while converting
+    to RGB, so full-resolution frames are never copied around.
+    """
+    return None if SAVE_FRAMES else CLIP_IMAGE_SIZE
+
+
+def frame_cache_path(url: str) -> str:
+    """
+    Path of the cached frames of a video, keyed by its URL and the sampled positions.
+    """
+    key = hashlib.sha256(f"{url}|{tuple(FRAME_PERCENTAGES)}|{decode_short_side()}".encode()).hexdigest()
+    return os.path.join(FRAME_CACHE_DIR, f"{key}.npz")
+
+
+def load_frame_cache(cache_path: str) -> Optional[List[np.ndarray]]:
+    """
+    Load a clip's cached frames, or return None if there are none. A file that
+    can't be read or doesn't hold RGB uint8 frames is removed and treated as a
+    miss, so the clip is downloaded again and the cache rewritten.
+    """
+    try:
+        with np.load(cache_path) as cached:
+            frames = cached["frames"]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning("  Ignoring unreadable cached frames at %s: %s", cache_path, e)
+        remove_file(cache_path)
+        return None
+
+    if frames.dtype != np.uint8 or frames.ndim != 4 or frames.shape[-1] != 3:
+        logger.warning("  Ignoring cached frames at %s: expected uint8 (n, H, W, 3), got %s %s",
+                       cache_path, frames.dtype, frames.shape)
+        remove_file(cache_path)
+        return None
+    return list(frames)
+
+
+def save_frame_cache(cache_path: str, frames: List[np.ndarray]):
+    """
+    Store a clip's frames as one stacked uint8 array. A failed write only
+    costs the next run a download, so errors are logged and ignored.
+    """
+    # write then rename so a run that's interrupted never leaves a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        # frames of different sizes (a resolution change mid-video) can't be
+        # stacked; that raises ValueError, before any file is created
+        stacked = np.stack(frames)
+        os.makedirs(FRAME_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, frames=stacked)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError) as e:
+        logger.warning("  Could not cache frames at %s: %s", cache_path, e)
+        remove_file(tmp_path)
+
+
+def remove_file(path: str):
+    """
+    Delete a file if it exists, in one call instead of checking first.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("  Could not remove %s: %s", path, e)
+
+
+def record_frame_cache(outcome: str):
+    with frame_cache_lock:
+        frame_cache_stats[outcome] += 1
+
+
+def iter_clip_frames(clips):
+    """
+    Download and decode clips concurrently, yielding each clip as soon as its frames are ready.
+
+    At most 2 * DOWNLOAD_WORKERS clips are in progress or waiting to be embedded
+    at any time, so the network and decoders stay busy while earlier clips go
+    through CLIP without finished clips piling up in memory.
+
+    Yields:
+        (clip, future) tuples; future.result() returns the clip's frames
+        or raises the download or extraction error
+    """
+    clips = iter(clips)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        pending = {pool.submit(load_clip_frames, clip): clip for clip in islice(clips, 2 * DOWNLOAD_WORKERS)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                clip = pending.pop(future)
+                next_clip = next(clips, None)
+                if next_clip is not None:
+                    pending[pool.submit(load_clip_frames, next_clip)] = next_clip
+                yield clip, future
+
+
+def save_frame(frame: np.ndarray, filename: str):
+    """
+    Write an RGB frame to disk, as a raw .npy array or a JPEG depending on
+    the filename's extension.
+    """
+    if filename.endswith(".npy"):
+        np.save(filename, frame)
+    else:
+        Image.fromarray(frame).save(filename, "JPEG", quality=85, optimize=False)
+
+
+def save_clip_frames(clip, frames: List[np.ndarray]) -> Tuple[List[Optional[str]], List[Future]]:
+    """
+    Start writing a clip's frames to disk in the background when SAVE_FRAMES is set.
+    Called as soon as the frames are extracted, so encoding overlaps with
+    batching and the CLIP forward pass instead of gating it.
+    
+    Returns:
+        (filenames, futures) tuple; filenames are None when frames aren't saved
+    """
+    if not SAVE_FRAMES:
+        return [None] * len(frames), []
+    
+    filenames = [f"{clip['id']}_frame_{i+1}.{FRAME_SAVE_FORMAT}" for i in range(len(frames))]
+    futures = [frame_writer.submit(save_frame, frame, filename) for frame, filename in zip(frames, filenames)]
+    return filenames, futures
+
+
+def save_clip_results(clip, embeddings: np.ndarray, frame_filenames: List[Optional[str]], frame_saves: List[Future]):
+    """
+    Check each frame embedding of a clip for inappropriate content and save
+    the moderation results to a JSON file.
+    """
+    logger.info("Checking content for %s...", clip['title'])
+    moderation_results = []
+    
+    # score all frames of the clip in one pass, then report them one by one
+    moderator = get_content_moderator()
+    scores = moderator.score_images(embeddings)
+    for i, frame_filename in enumerate(frame_filenames):
+        frame_moderation = moderator.results_for_image(scores, i)
+        log_moderation_results(frame_moderation, f"{clip['title']} - Frame {i+1}")
+        moderation_results.append({
+            "frame": i+1,
+            "filename": frame_filename,
+            "moderation": frame_moderation
+        })
+    
+    # make sure every frame the results point to is on disk
+    for future in frame_saves:
+        future.result()
+    
+    logger.info("✓ Got %d embeddings for %s", len(embeddings), clip['title'])
+    logger.info("  Embedding dimensions: %s", embeddings[0].shape if len(embeddings) else None)
+    
+    # Save moderation results to file
+    moderation_filename = f"{clip['id']}_moderation_results.json"
+    with open(moderation_filename, 'wb') as f:
+        f.write(orjson.dumps({
+            "clip_id": clip['id'],
+            "clip_title": clip['title'],
+            "frames_analyzed": len(embeddings),
+            "moderation_results": moderation_results
+        }, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    logger.info("✓ Saved moderation results to %s", moderation_filename)
+
+
+def frame_hash(frame: np.ndarray) -> np.ndarray:
+    """
+    Difference hash (dHash) of an RGB frame: whether each pixel of a 9x8
+    grayscale thumbnail is brighter than its left neighbour.
+    Returns a boolean array of 64 bits.
+    """
+    thumbnail = np.asarray(Image.fromarray(frame).convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return (thumbnail[:, 1:] > thumbnail[:, :-1]).ravel()
+
+def group_near_duplicates(frames: List[np.ndarray]) -> Tuple[List[int], List[int]]:
+    """
+    Group a clip's frames that show the same shot, by Hamming distance between
+    their perceptual hashes. The first frame of each group represents it.
+    
+    Returns:
+        (representatives, groups) tuple: indices of the representative frames,
+        and for every frame the position of its group's representative in
+        that list
+    """
+    if FRAME_DEDUP_DISTANCE < 0:
+        return list(range(len(frames))), list(range(len(frames)))
+    
+    representatives = []
+    hashes = []
+    groups = []
+    for i, frame in enumerate(frames):
+        frame_bits = frame_hash(frame)
+        for group, group_bits in enumerate(hashes):
+            if np.count_nonzero(frame_bits != group_bits) <= FRAME_DEDUP_DISTANCE:
+                groups.append(group)
+                break
+        else:
+            groups.append(len(representatives))
+            representatives.append(i)
+            hashes.append(frame_bits)
+    return representatives, groups
+
+def process_clip_batch(batch):
+    """
+    Embed the frames of several clips in one CLIP forward pass and save
+    the moderation results of each clip.
+    
+    Args:
+        batch: List of (clip, frames, frame_filenames, frame_saves) tuples
+    """
+    # near-duplicate frames within a clip are embedded once and share the result
+    clip_groups = [group_near_duplicates(frames) for _, frames, _, _ in batch]
+    unique_frames = [frames[i] for (_, frames, _, _), (representatives, _) in zip(batch, clip_groups) for i in representatives]
+    total_frames = sum(len(frames) for _, frames, _, _ in batch)
+    logger.info("\nGetting embeddings for %d frames from %d clips (%d near-duplicates skipped)...",
+                len(unique_frames), len(batch), total_frames - len(unique_frames))
+    try:
+        embeddings = get_image_embeddings(unique_frames)
+    except Exception as e:
+        logger.error("✗ Embedding failed for batch: %s", e)
+        if DEVICE == "cuda":
+            # after an out-of-memory error, hand the partly allocated blocks back
+            # so the next batch isn't starved by fragmentation
+            torch.cuda.empty_cache()
+        return
+    
+    # rows of the batch are in clip order, so split them back out per clip
+    split_points = np.cumsum([len(representatives) for representatives, _ in clip_groups])[:-1]
+    for (clip, frames, frame_filenames, frame_saves), (_, groups), clip_embeddings in zip(batch, clip_groups, np.split(embeddings, split_points)):
         try:
-            print(f"Processing: {clip['title']}")
-            download_video(video_url, local_path)
-            print(f"✓ Download completed for {clip['title']}")
-            
-            # Check if file was actually downloaded
-            if os.path.exists(local_path):
-                print(f"✓ File confirmed at: {local_path}")
-                
-                # Extract frames from the downloaded video
-                print(f"Extracting frames from {clip['title']}...")
-                try:
-                    frames = extract_frames_at_percentages(local_path)
-                    print(f"✓ Extracted {len(frames)} frames for {clip['title']}")
-                    
-                    # Get embeddings for each frame and check content moderation
-                    print(f"Getting embeddings and checking content for {clip['title']}...")
-                    embeddings = []
-                    moderation_results = []
-                    
-                    for i, img in enumerate(frames):
-                        # Save the frame
-                        frame_filename = f"{clip['id']}_frame_{i+1}.jpg"
-                        img.save(frame_filename)
-                        
-                        # Get embedding for this frame
-                        embedding = get_image_embedding(img)
-                        embeddings.append(embedding)
-                        
-                        # Check content moderation
-                        frame_moderation = check_content_moderation(embedding, f"{clip['title']} - Frame {i+1}")
-                        moderation_results.append({
-                            "frame": i+1,
-                            "filename": frame_filename,
-                            "moderation": frame_moderation
-                        })
-                        
-                        print(f"  Frame {i+1} embedding: {embedding}")
-                    
-                    print(f"✓ Got {len(embeddings)} embeddings for {clip['title']}")
-                    print(f"  Embedding dimensions: {embeddings[0].shape if embeddings else 'None'}")
-                    
-                    # Save moderation results to file
-                    import json
-                    moderation_filename = f"{clip['id']}_moderation_results.json"
-                    with open(moderation_filename, 'w') as f:
-                        json.dump({
-                            "clip_id": clip['id'],
-                            "clip_title": clip['title'],
-                            "frames_analyzed": len(frames),
-                            "moderation_results": moderation_results
-                        }, f, indent=2)
-                    print(f"✓ Saved moderation results to {moderation_filename}")
-                    
-                except Exception as frame_error:
-                    print(f"✗ Frame extraction failed for {clip['title']}: {frame_error}")
-            else:
-                print(f"✗ File not found at: {local_path}")
+            save_clip_results(clip, clip_embeddings[groups], frame_filenames, frame_saves)
+        except Exception as e:
+            logger.error("✗ Content check failed for %s: %s", clip['title'], e)
 
+
+def process_all_clips():
+    # clips are fetched page by page while earlier ones are processed
+    clips = iter_media_clips()
+    clip_count = 0
+    
+    # load CLIP and the moderator's word embeddings before the first batch
+    get_content_moderator()
+    
+    # frames of downloaded clips waiting to go through CLIP together
+    batch = []
+    batch_frames = 0
+    
+    # downloads and frame extraction run in a thread pool; each clip is
+    # batched here as soon as its frames are ready, while the rest keep going
+    for clip, frames_job in iter_clip_frames(clips):
+        clip_count += 1
+        logger.info("\n=== CLIP INFO ===")
+        logger.info("Title: %s", clip['title'])
+        logger.info("Clip path from DB: '%s'", clip['clip_path'])
+        try:
+            frames = frames_job.result()
         except Exception as e:
-            #print(f"✗ Failed to process {clip['title']}: {e}")
-            print("failed to download video", )
-        finally:
-            if os.path.exists(local_path):
-                os.remove(local_path)
+            logger.error("✗ Failed to download or extract frames for %s: %s", clip['title'], e)
+            continue
+        
+        logger.info("✓ Extracted %d frames for %s", len(frames), clip['title'])
+        if not frames:
+            continue
+        # flush first if this clip would push the batch past its size limit
+        if batch and batch_frames + len(frames) > INFERENCE_BATCH_SIZE:
+            process_clip_batch(batch)
+            batch = []
+            batch_frames = 0
+        batch.append((clip, frames, *save_clip_frames(clip, frames)))
+        batch_frames += len(frames)
+    
+    if batch:
+        process_clip_batch(batch)
+    
+    logger.info("\nProcessed %d clips from database", clip_count)
+    lookups = frame_cache_stats["hits"] + frame_cache_stats["misses"]
+    if lookups:
+        logger.info("Frame cache hit rate: %.0f%% (%d of %d clips)",
+                    100 * frame_cache_stats["hits"] / lookups, frame_cache_stats["hits"], lookups)
+
+def setup_logging() -> QueueListener:
+    """
+    Send log records through a queue so the console writes happen on a
+    background thread instead of blocking the download and batch loops.
+    
+    Returns:
+        The started listener; stop it before exiting to flush pending records
+    """
+    log_queue = queue.Queue(-1)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, console)
+    
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    return listener
 
 if __name__ == "__main__":
-    process_all_clips() 
+    log_listener = setup_logging()
+    try:
+        process_all_clips()
+    finally:
+        log_listener.stop()
     # clips = fetch_media_clips()
     # print(clips) 
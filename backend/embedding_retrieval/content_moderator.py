@@ -1,22 +1,36 @@
+import os
+import math
+import hashlib
 import numpy as np
 import torch
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from transformers.models.clip.processing_clip import CLIPProcessor
 from transformers.models.clip.modeling_clip import CLIPModel
 from PIL import Image
 import json
+import orjson
+
+# Word embeddings are cached here so later runs skip the text encoder; the
+# directory is per user, so no one else can plant a file that gets loaded
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "clip_content_analyzer",
+)
 
 class ContentModerator:
-    def __init__(self, clip_model, clip_processor):
+    def __init__(self, clip_model, clip_processor, cache_dir: Optional[str] = DEFAULT_CACHE_DIR):
         """
         Initialize the content moderator with CLIP model and processor.
         
         Args:
             clip_model: Pre-loaded CLIP model
             clip_processor: Pre-loaded CLIP processor
+            cache_dir: Directory where word embeddings are cached between runs
+                (None disables the cache)
         """
         self.clip_model = clip_model
         self.clip_processor = clip_processor
+        self.cache_dir = cache_dir
         
         # Define inappropriate content categories and words
         self.inappropriate_content = {
@@ -49,6 +63,95 @@ class ContentModerator:
         # Threshold for flagging content (cosine similarity)
         self.similarity_threshold = 0.25
         
+        # Normalized embeddings of every word, stacked into one matrix so an image
+        # can be compared against the whole vocabulary with a single matmul
+        self._all_words = []
+        self._cat_offsets = np.zeros(0, dtype=np.int64)
+        self._text_matrix = None
+        self._build_text_matrix()
+        
+    def _build_text_matrix(self):
+        """
+        Embed all inappropriate words in one batched CLIP forward pass.
+        
+        Words are stored category by category in self._all_words, with
+        self._cat_offsets holding the index where each category starts.
+        """
+        self._all_words = [word for words in self.inappropriate_content.values() for word in words]
+        counts = [len(words) for words in self.inappropriate_content.values()]
+        self._cat_offsets = np.cumsum([0] + counts[:-1]).astype(np.int64)
+        
+        cache_path = self._text_matrix_cache_path()
+        text_features = self._load_text_features(cache_path) if cache_path else None
+        if text_features is not None:
+            # seed the per-text cache too, so adding a word later only
+            # runs the new word through the text encoder
+            self.text_embeddings_cache.update(zip(self._all_words, text_features))
+        else:
+            text_features = self.get_text_embeddings(self._all_words)
+            if cache_path:
+                self._save_text_features(cache_path, text_features)
+        
+        # L2-normalize rows so a dot product with a unit image vector is the cosine similarity
+        self._text_matrix = text_features / np.linalg.norm(text_features, axis=1, keepdims=True)
+    
+    def _load_text_features(self, cache_path: str) -> Optional[np.ndarray]:
+        """
+        Load cached word embeddings, or return None if there are none or the
+        file doesn't hold one float32 row per word, so they get recomputed.
+        """
+        try:
+            text_features = np.load(cache_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable word embedding cache {cache_path}: {e}")
+            return None
+        if not isinstance(text_features, np.ndarray):
+            text_features.close()
+            print(f"Ignoring word embedding cache {cache_path}: not a single array")
+            return None
+        
+        expected_shape = (len(self._all_words), self.clip_model.config.projection_dim)
+        if text_features.shape != expected_shape or text_features.dtype != np.float32:
+            print(f"Ignoring word embedding cache {cache_path}: expected float32 {expected_shape}, "
+                  f"got {text_features.dtype} {text_features.shape}")
+            return None
+        return text_features
+    
+    def _save_text_features(self, cache_path: str, text_features: np.ndarray):
+        """
+        Save the unnormalized word embeddings, so a later run can both build
+        the word matrix and fill text_embeddings_cache from them.
+        """
+        # write then rename so a concurrent run never loads a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, text_features)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not cache word embeddings: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    
+    def _text_matrix_cache_path(self) -> Optional[str]:
+        """
+        Path of the cached word embeddings for the current vocabulary.
+        
+        The file name hashes the model name, its dtype and the vocabulary, so
+        adding a word or switching models picks a new file automatically.
+        """
+        if not self.cache_dir:
+            return None
+        model_name = getattr(self.clip_model.config, "_name_or_path", "")
+        key_source = model_name + str(self.clip_model.dtype) + json.dumps(self.inappropriate_content, sort_keys=True)
+        key = hashlib.sha256(key_source.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"clip_word_embeddings_{key}.npy")
+        
     def get_text_embedding(self, text: str) -> np.ndarray:
         """
         Get CLIP embedding for a text string.
@@ -65,19 +168,43 @@ class ContentModerator:
         
         # Process text through CLIP processor
         inputs = self.clip_processor(text=text, return_tensors="pt", padding=True, truncation=True)
+        inputs = {name: tensor.to(self.clip_model.device) for name, tensor in inputs.items()}
         
         # Get text features from CLIP model
-        with torch.no_grad():
+        with torch.inference_mode():
             text_features = self.clip_model.get_text_features(**inputs)
         
         # Convert to numpy array and flatten
-        embedding = text_features.numpy().flatten()
+        embedding = text_features.float().cpu().numpy().flatten()
         
         # Cache the result
         self.text_embeddings_cache[text] = embedding
         
         return embedding
     
+    def get_text_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Get CLIP embeddings for several text strings in one forward pass.
+        
+        Args:
+            texts: Text strings to embed
+            
+        Returns:
+            numpy array of shape (len(texts), embedding_dim), rows matching
+            get_text_embedding for each text
+        """
+        # Only run the texts that aren't cached yet through CLIP
+        missing = list(dict.fromkeys(text for text in texts if text not in self.text_embeddings_cache))
+        if missing:
+            inputs = self.clip_processor(text=missing, return_tensors="pt", padding=True, truncation=True)
+            inputs = {name: tensor.to(self.clip_model.device) for name, tensor in inputs.items()}
+            with torch.inference_mode():
+                text_features = self.clip_model.get_text_features(**inputs)
+            for text, embedding in zip(missing, text_features.float().cpu().numpy()):
+                self.text_embeddings_cache[text] = embedding
+        
+        return np.stack([self.text_embeddings_cache[text] for text in texts])
+    
     def cosine_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
         """
         Calculate cosine similarity between two embeddings.
@@ -89,72 +216,160 @@ class ContentModerator:
         Returns:
             Cosine similarity score between 0 and 1
         """
-        # Normalize vectors
-        norm1 = np.linalg.norm(embedding1)
-        norm2 = np.linalg.norm(embedding2)
+        # Same dtype and contiguous, so every product takes the BLAS sdot path
+        # instead of numpy's casting loop (a no-op for CLIP's float32 outputs)
+        embedding1 = np.ascontiguousarray(embedding1, dtype=np.float32)
+        embedding2 = np.ascontiguousarray(embedding2, dtype=np.float32)
         
-        if norm1 == 0 or norm2 == 0:
+        # Three dot products, no intermediate normalized copies
+        squared_norms = float(np.vdot(embedding1, embedding1)) * float(np.vdot(embedding2, embedding2))
+        
+        if squared_norms == 0:
             return 0.0
         
-        # Calculate cosine similarity
-        similarity = np.dot(embedding1, embedding2) / (norm1 * norm2)
-        return float(similarity)
+        return float(np.vdot(embedding1, embedding2)) / math.sqrt(squared_norms)
     
-    def check_image_content(self, image_embedding: np.ndarray) -> Dict:
+    def _word_similarities(self, image_embeddings: np.ndarray) -> np.ndarray:
         """
-        Check if an image embedding is similar to any inappropriate content.
+        Cosine similarity of every image against every word at once.
+        
+        Returns:
+            Array of shape (num_images, num_words), columns in self._all_words order
+        """
+        if self._text_matrix is None:
+            self._build_text_matrix()
+        
+        image_embeddings = np.asarray(image_embeddings, dtype=self._text_matrix.dtype).reshape(-1, self._text_matrix.shape[1])
+        norms = np.linalg.norm(image_embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0  # zero embeddings stay zero and match nothing
+        return (image_embeddings / norms) @ self._text_matrix.T
+    
+    def compute_similarities(self, image_embedding: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Get the raw similarity of an image to every inappropriate word, without
+        applying the threshold, e.g. to try several thresholds on one image.
         
         Args:
-            image_embedding: Image embedding to check
+            image_embedding: Image embedding to compare
             
         Returns:
-            Dictionary with moderation results
+            Dictionary of categories and the similarity to each of their words,
+            in get_inappropriate_words order
         """
-        results = {
-            "flagged": False,
-            "categories": {},
-            "max_similarity": 0.0,
-            "most_similar_content": None
+        similarities = self._word_similarities(image_embedding)[0]
+        ends = list(self._cat_offsets[1:]) + [len(self._all_words)]
+        return {
+            category: similarities[start:end]
+            for category, start, end in zip(self.inappropriate_content, self._cat_offsets, ends)
         }
+    
+    def score_images(self, image_embeddings: np.ndarray) -> Dict:
+        """
+        Score a batch of image embeddings against every inappropriate word.
         
-        max_similarity = 0.0
-        most_similar_content = None
+        Results are kept as parallel numpy arrays (one row per image, one column
+        per category) instead of nested dictionaries; use results_for_image to
+        turn one row into the dictionary returned by check_image_content.
         
-        # Check each category
-        for category, words in self.inappropriate_content.items():
-            category_max_similarity = 0.0
-            category_most_similar = None
+        Args:
+            image_embeddings: Image embeddings of shape (num_images, embedding_dim)
             
-            for word in words:
-                try:
-                    text_embedding = self.get_text_embedding(word)
-                    similarity = self.cosine_similarity(image_embedding, text_embedding)
-                    
-                    if similarity > category_max_similarity:
-                        category_max_similarity = similarity
-                        category_most_similar = word
-                    
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        most_similar_content = word
-                        
-                except Exception as e:
-                    print(f"Error processing word '{word}': {e}")
-                    continue
+        Returns:
+            Dictionary with:
+                categories: Category names, in column order
+                category_max: (num_images, num_categories) highest positive similarity per category, 0 if none
+                category_best: (num_images, num_categories) index into the word list of that word, -1 if none
+                max_similarity: (num_images,) highest similarity over all categories
+                best_word: (num_images,) index of the most similar word, -1 if none
+                flagged: (num_images,) whether max_similarity is above the threshold
+        """
+        similarities = self._word_similarities(image_embeddings)
+        
+        num_images = len(similarities)
+        rows = np.arange(num_images)
+        categories = list(self.inappropriate_content)
+        category_max = np.zeros((num_images, len(categories)), dtype=np.float32)
+        category_best = np.full((num_images, len(categories)), -1, dtype=np.int64)
+        
+        # Reduce each category's columns; only positive similarities count
+        ends = list(self._cat_offsets[1:]) + [len(self._all_words)]
+        for k, (start, end) in enumerate(zip(self._cat_offsets, ends)):
+            if end == start:
+                continue
+            best = start + np.argmax(similarities[:, start:end], axis=1)
+            best_similarity = similarities[rows, best]
+            positive = best_similarity > 0.0
+            category_max[:, k] = np.where(positive, best_similarity, 0.0)
+            category_best[:, k] = np.where(positive, best, -1)
+        
+        # argmax keeps the first category on ties, as the earlier per-category loop did
+        best_category = np.argmax(category_max, axis=1)
+        max_similarity = category_max[rows, best_category]
+        best_word = category_best[rows, best_category]
+        
+        return {
+            "categories": categories,
+            "category_max": category_max,
+            "category_best": category_best,
+            "max_similarity": max_similarity,
+            "best_word": best_word,
+            "flagged": max_similarity > self.similarity_threshold
+        }
+    
+    def results_for_image(self, scores: Dict, index: int) -> Dict:
+        """
+        Build the moderation results dictionary of one image from score_images output.
+        Words are only looked up here, when the results are reported.
+        
+        Args:
+            scores: Output of score_images
+            index: Row of the image in the scored batch
             
-            # Store category results
+        Returns:
+            Dictionary with moderation results
+        """
+        def word(word_index):
+            return self._all_words[word_index] if word_index >= 0 else None
+        
+        results = {
+            "flagged": bool(scores["flagged"][index]),
+            "categories": {},
+            "max_similarity": float(scores["max_similarity"][index]),
+            "most_similar_content": word(scores["best_word"][index])
+        }
+        for k, category in enumerate(scores["categories"]):
+            category_max_similarity = float(scores["category_max"][index, k])
             results["categories"][category] = {
                 "max_similarity": category_max_similarity,
-                "most_similar_word": category_most_similar,
+                "most_similar_word": word(scores["category_best"][index, k]),
                 "flagged": category_max_similarity > self.similarity_threshold
             }
+        return results
+    
+    def check_image_content(self, image_embedding: np.ndarray) -> Dict:
+        """
+        Check if an image embedding is similar to any inappropriate content.
         
-        # Update overall results
-        results["max_similarity"] = max_similarity
-        results["most_similar_content"] = most_similar_content
-        results["flagged"] = max_similarity > self.similarity_threshold
+        Args:
+            image_embedding: Image embedding to check
+            
+        Returns:
+            Dictionary with moderation results
+        """
+        return self.results_for_image(self.score_images(image_embedding), 0)
+    
+    def check_image_batch(self, image_embeddings: np.ndarray) -> List[Dict]:
+        """
+        Check several image embeddings at once, e.g. all frames of a clip.
         
-        return results
+        Args:
+            image_embeddings: Image embeddings of shape (num_images, embedding_dim)
+            
+        Returns:
+            List of moderation results dictionaries, one per image
+        """
+        scores = self.score_images(image_embeddings)
+        return [self.results_for_image(scores, i) for i in range(len(scores["flagged"]))]
     
     def get_inappropriate_words(self) -> Dict[str, List[str]]:
         """
@@ -178,8 +393,10 @@ class ContentModerator:
         
         if word not in self.inappropriate_content[category]:
             self.inappropriate_content[category].append(word)
-            # Clear cache since we added new content
-            self.text_embeddings_cache.clear()
+            # The word matrix is rebuilt on the next check, so several additions
+            # cost one pass; embeddings of existing words are still cached, so
+            # only the new words go through the text encoder
+            self._text_matrix = None
     
     def set_similarity_threshold(self, threshold: float):
         """
@@ -201,5 +418,5 @@ class ContentModerator:
             results: Moderation results dictionary
             filename: Output filename
         """
-        with open(filename, 'w') as f:
-            json.dump(results, f, indent=2) 
\ No newline at end of file
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
\ No newline at end of file
@@ -0,0 +1,135 @@
+import io
+from collections import OrderedDict
+from typing import Optional
+
+import requests
+
+
+def content_range_total(response: requests.Response) -> Optional[int]:
+    """
+    Get the total size of a resource from a 206 response's Content-Range header.
+
+    Args:
+        response: Response to a Range request
+
+    Returns:
+        Total size in bytes, or None if the server didn't report it
+    """
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file over an HTTP resource that only downloads the
+    parts that are actually read, using Range requests.
+
+    Reads are served from fixed-size blocks, and the most recently used blocks
+    are kept in memory so the small sequential reads of a demuxer don't each
+    turn into a request.
+    """
+
+    def __init__(self, session: requests.Session, url: str, size: int,
+                 block_size: int = 1024 * 1024, max_blocks: int = 16, timeout=None):
+        """
+        Args:
+            session: Session used for the Range requests
+            url: URL of the resource (the server must support Range requests)
+            size: Total size of the resource in bytes
+            block_size: Number of bytes fetched per request
+            max_blocks: Number of fetched blocks kept in memory
+            timeout: Timeout passed to each request
+        """
+        super().__init__()
+        self.session = session
+        self.url = url
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.timeout = timeout
+        self.bytes_fetched = 0
+        self._blocks = OrderedDict()
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position: {pos}")
+        self._pos = pos
+        return pos
+
+    def block_length(self, index: int) -> int:
+        """
+        Number of bytes in a block; only the last block can be shorter than block_size.
+        """
+        return max(0, min(self.block_size, self.size - index * self.block_size))
+
+    def add_block(self, index: int, data: bytes):
+        """
+        Store an already downloaded block, e.g. the first block of a probe request.
+        The data must be the whole block (see block_length).
+        """
+        if len(data) != self.block_length(index):
+            raise ValueError(f"Block {index} must be {self.block_length(index)} bytes, got {len(data)}")
+        self._blocks[index] = data
+        self._blocks.move_to_end(index)
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def _get_block(self, index: int) -> bytes:
+        if index in self._blocks:
+            self._blocks.move_to_end(index)
+            return self._blocks[index]
+
+        start = index * self.block_size
+        end = start + self.block_length(index) - 1
+        # servers may return less than the requested range, so keep asking
+        # for the rest until the block is complete
+        chunks = []
+        pos = start
+        while pos <= end:
+            response = self.session.get(self.url, headers={"Range": f"bytes={pos}-{end}"}, timeout=self.timeout)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored Range request for {self.url}")
+            if not response.content:
+                raise IOError(f"Empty reply to Range request bytes={pos}-{end} for {self.url}")
+            chunk = response.content[:end - pos + 1]
+            chunks.append(chunk)
+            pos += len(chunk)
+            self.bytes_fetched += len(chunk)
+
+        data = b"".join(chunks)
+        self.add_block(index, data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self.size:
+            return 0
+        index, offset = divmod(self._pos, self.block_size)
+        block = self._get_block(index)
+        # short reads are allowed; the caller asks again for the rest
+        n = max(0, min(len(buffer), len(block) - offset))
+        buffer[:n] = block[offset:offset + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        self._blocks.clear()
+        super().close()
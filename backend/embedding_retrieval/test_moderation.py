@@ -4,6 +4,7 @@ Test script for content moderation functionality.
 This script demonstrates how to use the ContentModerator class.
 """
 
+import os
 import numpy as np
 import torch
 from transformers.models.clip.processing_clip import CLIPProcessor
@@ -20,6 +21,10 @@ def test_text_embeddings():
     print("Loading CLIP model...")
     clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
     clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+    clip_model.eval()
+    # a few intra-op threads are enough for the text tower, and leave cores
+    # free when this runs next to the processing pipeline
+    torch.set_num_threads(min(4, os.cpu_count() or 1))
     
     # Initialize content moderator
     moderator = ContentModerator(clip_model, clip_processor)
@@ -28,15 +33,13 @@ def test_text_embeddings():
     test_words = ["violence", "gun", "blood", "nude", "drugs", "hate"]
     
     print("\nTesting text embeddings for inappropriate words:")
-    for word in test_words:
-        embedding = moderator.get_text_embedding(word)
+    embeddings = moderator.get_text_embeddings(test_words)
+    for word, embedding in zip(test_words, embeddings):
         print(f"  '{word}': {embedding.shape} - {embedding[:5]}...")
     
     # Test similarity between related words
     print("\nTesting similarity between related words:")
-    violence_emb = moderator.get_text_embedding("violence")
-    gun_emb = moderator.get_text_embedding("gun")
-    peace_emb = moderator.get_text_embedding("peace")
+    violence_emb, gun_emb, peace_emb = moderator.get_text_embeddings(["violence", "gun", "peace"])
     
     violence_gun_sim = moderator.cosine_similarity(violence_emb, gun_emb)
     violence_peace_sim = moderator.cosine_similarity(violence_emb, peace_emb)
@@ -62,13 +65,54 @@ def test_content_checking(moderator):
     print(f"Max similarity: {results['max_similarity']:.3f}")
     print(f"Most similar content: '{results['most_similar_content']}'")
     
+    # many frames are checked in one call; the first row is the sample above
+    batch = np.vstack([sample_embedding, np.random.randn(99, 512)])
+    batch_results = moderator.check_image_batch(batch)
+    assert batch_results[0]["most_similar_content"] == results["most_similar_content"]
+    print(f"Batch check: {sum(r['flagged'] for r in batch_results)} of {len(batch_results)} embeddings flagged")
+    
+    # summarize straight from the raw similarity arrays
     print("\nCategory breakdown:")
-    for category, details in results["categories"].items():
-        status = "⚠️ FLAGGED" if details["flagged"] else "✓ OK"
-        print(f"  {category}: {status} (similarity: {details['max_similarity']:.3f})")
+    words = moderator.get_inappropriate_words()
+    for category, similarities in moderator.compute_similarities(sample_embedding).items():
+        status = "⚠️ FLAGGED" if results["categories"][category]["flagged"] else "✓ OK"
+        best = int(np.argmax(similarities))
+        print(f"  {category}: {status} (similarity: {similarities[best]:.3f}, word: '{words[category][best]}')")
     
     return results
 
+def test_batched_matches_per_word(moderator):
+    """Test that the batched word matrix gives the same scores as per-word comparison."""
+    print("\n=== Testing Batched Similarity ===")
+    
+    sample_embedding = np.random.randn(512)
+    results = moderator.check_image_content(sample_embedding)
+    
+    # the word matrix was built from text_embeddings_cache, so empty it to
+    # embed each word again in its own forward pass for the reference
+    saved_cache = dict(moderator.text_embeddings_cache)
+    moderator.text_embeddings_cache.clear()
+    try:
+        for category, words in moderator.get_inappropriate_words().items():
+            per_word = [moderator.cosine_similarity(sample_embedding, moderator.get_text_embedding(word)) for word in words]
+            expected = max([0.0] + per_word)
+            actual = results["categories"][category]["max_similarity"]
+            assert abs(expected - actual) < 1e-4, f"{category}: {actual:.5f} != {expected:.5f}"
+            print(f"  {category}: {actual:.4f} matches per-word {expected:.4f}")
+    finally:
+        moderator.text_embeddings_cache.clear()
+        moderator.text_embeddings_cache.update(saved_cache)
+    
+    # scoring several images at once gives the same results as one at a time
+    batch = np.stack([sample_embedding, np.random.randn(512), np.zeros(512)])
+    scores = moderator.score_images(batch)
+    for i, embedding in enumerate(batch):
+        batched = moderator.results_for_image(scores, i)
+        single = moderator.check_image_content(embedding)
+        assert batched["most_similar_content"] == single["most_similar_content"], f"image {i}: best word differs"
+        assert abs(batched["max_similarity"] - single["max_similarity"]) < 1e-5, f"image {i}: max similarity differs"
+    print(f"  score_images matches check_image_content for {len(batch)} images")
+
 def test_threshold_adjustment(moderator):
     """Test how changing the threshold affects flagging."""
     print("\n=== Testing Threshold Adjustment ===")
@@ -79,10 +123,16 @@ def test_threshold_adjustment(moderator):
     
     thresholds = [0.5, 0.6, 0.7, 0.8, 0.9]
     
+    # similarities don't depend on the threshold, so compute them once
+    similarities = moderator.compute_similarities(sample_embedding)
+    max_similarity = max([0.0] + [float(sims.max()) for sims in similarities.values() if len(sims)])
     for threshold in thresholds:
-        moderator.set_similarity_threshold(threshold)
-        results = moderator.check_image_content(sample_embedding)
-        print(f"Threshold {threshold}: {'FLAGGED' if results['flagged'] else 'OK'} (max sim: {results['max_similarity']:.3f})")
+        flagged = max_similarity > threshold
+        print(f"Threshold {threshold}: {'FLAGGED' if flagged else 'OK'} (max sim: {max_similarity:.3f})")
+    
+    # the threshold is applied the same way by check_image_content
+    moderator.set_similarity_threshold(thresholds[0])
+    assert moderator.check_image_content(sample_embedding)["flagged"] == (max_similarity > thresholds[0])
 
 def test_custom_words(moderator):
     """Test adding custom inappropriate words."""
@@ -111,10 +161,13 @@ def main():
         # Test 2: Content checking
         test_content_checking(moderator)
         
-        # Test 3: Threshold adjustment
+        # Test 3: Batched similarity matches per-word similarity
+        test_batched_matches_per_word(moderator)
+        
+        # Test 4: Threshold adjustment
         test_threshold_adjustment(moderator)
         
-        # Test 4: Custom words
+        # Test 5: Custom words
         test_custom_words(moderator)
         
         print("\n" + "=" * 40)